@@ -0,0 +1,357 @@
+"""
+lanbus: a tiny local pub/sub and shared-state broker for LANChatShare
+-------------------------------------------------------------------
+Lets several app processes on one machine (or LAN) share Socket.IO events,
+presence and typing state without running Redis. It is a stand-in for
+development and small deployments, not a durable store: all state lives in
+the broker's memory.
+
+Run the broker:
+    python lanbus.py --port 6380
+    python lanbus.py --unix /tmp/lanbus.sock
+
+Point the app at it:
+    SOCKETIO_MESSAGE_QUEUE=lanbus://127.0.0.1:6380
+    SOCKETIO_MESSAGE_QUEUE=lanbus+unix:///tmp/lanbus.sock
+
+Protocol: one JSON object per line. Requests carry an ``id`` and an ``op``
+and get back ``{"id": ..., "result": ...}`` or ``{"id": ..., "error": ...}``.
+Subscribed connections also receive ``{"channel": ..., "data": ...}`` pushes.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+
+# --- Broker ---
+class BrokerState:
+    """In-memory keys, hashes and channel subscriptions shared by all connections."""
+
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            return True
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = int(self.values.get(key) or 0) + amount
+            self.values[key] = value
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            found = self.values.pop(key, None) is not None
+            found = self.hashes.pop(key, None) is not None or found
+            return int(found)
+
+    def hincrby(self, key, field, amount=1):
+        with self.lock:
+            h = self.hashes.setdefault(key, {})
+            h[field] = int(h.get(field) or 0) + amount
+            return h[field]
+
+    def hset(self, key, field, value):
+        with self.lock:
+            h = self.hashes.setdefault(key, {})
+            added = field not in h
+            h[field] = value
+            return int(added)
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self.hashes.get(key, {}))
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            h = self.hashes.get(key, {})
+            return sum(1 for f in fields if h.pop(f, None) is not None)
+
+    def subscribe(self, channel, conn):
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(conn)
+            return True
+
+    def unsubscribe(self, conn, channel=None):
+        with self.lock:
+            channels = [channel] if channel else list(self.subscribers)
+            for c in channels:
+                self.subscribers.get(c, set()).discard(conn)
+            return True
+
+    def publish(self, channel, data):
+        with self.lock:
+            targets = list(self.subscribers.get(channel, ()))
+        frame = json.dumps({'channel': channel, 'data': data})
+        delivered = 0
+        for conn in targets:
+            if conn.send(frame):
+                delivered += 1
+        return delivered
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """Serve one client connection: run its requests and deliver its subscriptions."""
+
+    COMMANDS = {'get', 'set', 'incr', 'delete', 'hincrby', 'hset', 'hgetall', 'hdel'}
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def send(self, frame):
+        try:
+            with self.write_lock:
+                self.wfile.write(frame.encode() + b'\n')
+                self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+    def handle(self):
+        state = self.server.state
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    req = json.loads(line)
+                    op = req.get('op')
+                    args = req.get('args', [])
+                    if op == 'ping':
+                        result = 'pong'
+                    elif op == 'publish':
+                        result = state.publish(*args)
+                    elif op == 'subscribe':
+                        result = state.subscribe(args[0], self)
+                    elif op == 'unsubscribe':
+                        result = state.unsubscribe(self, *args)
+                    elif op in self.COMMANDS:
+                        result = getattr(state, op)(*args)
+                    else:
+                        raise ValueError(f'unknown op {op!r}')
+                    reply = {'id': req.get('id'), 'result': result}
+                except Exception as e:
+                    reply = {'id': req.get('id') if isinstance(req, dict) else None, 'error': str(e)}
+                self.send(json.dumps(reply))
+        except OSError:
+            pass
+        finally:
+            state.unsubscribe(self)
+
+
+class TCPBroker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class UnixBroker(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def make_broker(host='127.0.0.1', port=6380, unix_path=None):
+    """Create (but do not start) a broker server listening on TCP or a Unix socket."""
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        server = UnixBroker(unix_path, BrokerHandler)
+    else:
+        server = TCPBroker((host, port), BrokerHandler)
+    server.state = BrokerState()
+    return server
+
+
+# --- Client ---
+class LanBusError(Exception):
+    """Raised when the broker rejects a request."""
+
+
+class LanBusClient:
+    """Client for the lanbus broker. Method names follow redis-py so the two are interchangeable."""
+
+    def __init__(self, url, timeout=5.0):
+        parsed = urlparse(url)
+        if parsed.scheme == 'lanbus+unix':
+            self.address = parsed.path
+            self.family = socket.AF_UNIX
+        elif parsed.scheme == 'lanbus':
+            self.address = (parsed.hostname or '127.0.0.1', parsed.port or 6380)
+            self.family = socket.AF_INET
+        else:
+            raise ValueError(f'Not a lanbus URL: {url}')
+        self.url = url
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    def _open(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        return sock, sock.makefile('rb')
+
+    def _peer_closed(self):
+        """Check, without blocking, whether the broker has closed our idle connection (e.g. it restarted)."""
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            return bool(readable) and not self._sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _close(self):
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._file = None
+
+    # Ops the broker may safely run twice; only these are re-sent after the connection drops mid-request
+    IDEMPOTENT_OPS = frozenset({'ping', 'get', 'set', 'delete', 'hset', 'hgetall', 'hdel'})
+
+    def call(self, op, *args):
+        """Send one request and wait for its reply, reconnecting once if the connection dropped.
+
+        A request that may already have reached the broker is only re-sent if
+        it is idempotent: repeating incr, hincrby or publish would count or
+        deliver it twice, so those raise instead.
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                sent = False
+                try:
+                    if self._sock is not None and self._peer_closed():
+                        self._close()
+                    if self._sock is None:
+                        self._sock, self._file = self._open()
+                    req_id = next(self._ids)
+                    sent = True  # even a failed sendall may have delivered the whole request
+                    self._sock.sendall(json.dumps({'id': req_id, 'op': op, 'args': list(args)}).encode() + b'\n')
+                    while True:
+                        line = self._file.readline()
+                        if not line:
+                            raise ConnectionError('lanbus connection closed')
+                        reply = json.loads(line)
+                        if reply.get('id') == req_id:
+                            break
+                    break
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt == 2 or (sent and op not in self.IDEMPOTENT_OPS):
+                        raise
+        if 'error' in reply:
+            raise LanBusError(reply['error'])
+        return reply['result']
+
+    def ping(self):
+        return self.call('ping') == 'pong'
+
+    def get(self, key):
+        return self.call('get', key)
+
+    def set(self, key, value):
+        return self.call('set', key, value)
+
+    def incr(self, key, amount=1):
+        return self.call('incr', key, amount)
+
+    def delete(self, key):
+        return self.call('delete', key)
+
+    def hincrby(self, key, field, amount=1):
+        return self.call('hincrby', key, field, amount)
+
+    def hset(self, key, field, value):
+        return self.call('hset', key, field, value)
+
+    def hgetall(self, key):
+        return self.call('hgetall', key)
+
+    def hdel(self, key, *fields):
+        return self.call('hdel', key, *fields)
+
+    def publish(self, channel, message):
+        return self.call('publish', channel, message)
+
+    def listen(self, channels):
+        """Yield messages published on the given channels, on a dedicated connection."""
+        sock, rfile = self._open()
+        sock.settimeout(None)
+        try:
+            for i, channel in enumerate(channels):
+                sock.sendall(json.dumps({'id': i, 'op': 'subscribe', 'args': [channel]}).encode() + b'\n')
+            for line in rfile:
+                frame = json.loads(line)
+                if 'channel' in frame:
+                    yield frame['data']
+        finally:
+            sock.close()
+
+
+# --- Socket.IO client manager ---
+class LanBusManager(socketio.PubSubManager):
+    """Socket.IO client manager that fans events out to other app processes through lanbus.
+
+    Usage: ``SocketIO(app, client_manager=LanBusManager('lanbus://127.0.0.1:6380'))``
+    """
+    name = 'lanbus'
+
+    def __init__(self, url='lanbus://127.0.0.1:6380', channel='flask-socketio', write_only=False, logger=None,
+                 json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.client = LanBusClient(url)
+
+    def _publish(self, data):
+        return self.client.publish(self.channel, self.json.dumps(data))
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                yield from self.client.listen([self.channel])
+            except OSError:
+                self._get_logger().error('Cannot receive from lanbus... retrying in %s secs', retry_sleep)
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local pub/sub and shared-state broker for LANChatShare.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    opts = parser.parse_args()
+    server = make_broker(opts.host, opts.port, opts.unix)
+    print(f"lanbus listening on {opts.unix or f'{opts.host}:{opts.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
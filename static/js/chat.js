@@ -5,24 +5,76 @@ let groupUsers = [];
 // Store drafts per chat
 let chatDrafts = {};
 
+// History paging state for the open chat
+const HISTORY_PAGE_SIZE = 50;
+let historyQuery = null;
+let historyExhausted = false;
+let historyLoading = false;
+
+// Last presence version applied to the user list
+let presenceVersion = null;
+
+// Files at least this large go through the resumable chunked upload
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 8;
+// Files in this range are hashed first so content the server already has is not sent again
+const HASH_FIRST_MIN_SIZE = 256 * 1024;
+const HASH_FIRST_MAX_SIZE = 1024 * 1024 * 1024;
+
 function scrollChatToBottom() {
   let chatBody = document.getElementById('chat-body');
   chatBody.scrollTop = chatBody.scrollHeight;
 }
 
-function renderMessage(msg, isLatest = false) {
-  let fileHtml = '';
-  if (msg.file) {
-    if (msg.file.mimetype.startsWith('image/')) {
-      fileHtml = `<div><img src="/uploads/${msg.file.filename}" style="max-width:200px;" class="img-thumbnail"></div>`;
-    } else if (msg.file.mimetype.startsWith('video/')) {
-      fileHtml = `<div><video controls style="max-width:200px;"><source src="/uploads/${msg.file.filename}" type="${msg.file.mimetype}"></video></div>`;
-    } else if (msg.file.mimetype.startsWith('audio/')) {
-      fileHtml = `<div><audio controls style='max-width:200px;'><source src="/uploads/${msg.file.filename}" type="${msg.file.mimetype}"></audio></div>`;
+// Files whose preview is still being generated, by id, until 'file_preview' arrives
+let pendingPreviews = {};
+
+function renderFile(file) {
+  let url = `/uploads/${file.filename}`;
+  let html;
+  if (file.mimetype.startsWith('image/')) {
+    if (file.preview_url) {
+      html = `<a href="${url}" target="_blank"><img src="${file.preview_url}" style="max-width:200px;" class="img-thumbnail"></a>`;
+    } else if (file.preview_pending) {
+      html = `<a href="${url}" target="_blank" class="btn btn-light btn-sm"><i class="bi bi-image"></i> ${file.original_name}</a>`;
     } else {
-      fileHtml = `<div><a href="/uploads/${msg.file.filename}" target="_blank">${msg.file.original_name}</a></div>`;
+      html = `<img src="${url}" style="max-width:200px;" class="img-thumbnail">`;
     }
+  } else if (file.mimetype.startsWith('video/')) {
+    let poster = file.preview_url ? ` poster="${file.preview_url}" preload="none"` : ' preload="metadata"';
+    html = `<video controls${poster} style="max-width:200px;"><source src="${url}" type="${file.mimetype}"></video>`;
+  } else if (file.mimetype.startsWith('audio/')) {
+    html = `<audio controls style='max-width:200px;'><source src="${url}" type="${file.mimetype}"></audio>`;
+  } else if (file.preview_url) {
+    html = `<a href="${url}" target="_blank"><img src="${file.preview_url}" style="max-width:200px;" class="img-thumbnail"></a><br><a href="${url}" target="_blank">${file.original_name}</a>`;
+  } else {
+    html = `<a href="${url}" target="_blank">${file.original_name}</a>`;
   }
+  if (file.preview_pending) pendingPreviews[file.id] = file;
+  return `<div class="msg-file" data-file-id="${file.id}">${html}</div>`;
+}
+
+// Read receipts are sent once per rendered batch as a "read up to" watermark per chat
+let pendingReads = {};
+let readReceiptTimer = null;
+
+function queueReadReceipt(msgId) {
+  if (!currentRecipients) return;
+  pendingReads[currentRecipients] = Math.max(pendingReads[currentRecipients] || 0, msgId);
+  if (readReceiptTimer) return;
+  readReceiptTimer = setTimeout(function() {
+    readReceiptTimer = null;
+    const reads = pendingReads;
+    pendingReads = {};
+    for (const [recipients, upTo] of Object.entries(reads)) {
+      socket.emit('mark_read', {recipients: recipients, up_to: upTo});
+    }
+  }, 200);
+}
+
+function renderMessage(msg, isLatest = false, prepend = false) {
+  let fileHtml = msg.file ? renderFile(msg.file) : '';
   let msgClass = '';
   let deleteBtn = '';
   // Show delete button for all messages (own and friend's)
@@ -46,10 +98,8 @@ function renderMessage(msg, isLatest = false) {
     (msg.recipients.split(',').includes(USERNAME) && currentRecipients)
   ) {
     msgClass = 'theirs';
-    // Mark as read if not already
-    if (msg.status !== 'read') {
-      socket.emit('message_read', {msg_id: msg.id});
-    }
+    // Advance the read watermark (also for messages already ticked read, so the unread counter catches up)
+    queueReadReceipt(msg.id);
   }
   if (isLatest) msgClass += ' latest';
   // Show reply preview if this is a reply
@@ -82,20 +132,144 @@ function renderMessage(msg, isLatest = false) {
     </div>
     <span class="timestamp${isLatest ? ' always' : ''}">${msg.timestamp}</span>
   </div>`;
+  if (prepend) {
+    $('#chat-body').prepend(html);
+    return;
+  }
   $('#chat-body').append(html);
   scrollChatToBottom();
 }
 
 function loadHistory(filter) {
   $('#chat-body').html('<div class="text-center text-muted">Loading...</div>');
-  $.get('/history', {user: filter}, function(data) {
+  historyQuery = {user: filter};
+  historyExhausted = false;
+  $.get('/history', historyQuery, function(data) {
     $('#chat-body').empty();
+    historyExhausted = data.length < HISTORY_PAGE_SIZE;
     data.forEach(function(msg, idx) {
       renderMessage(msg, idx === data.length - 1);
     });
   });
 }
 
+// Fetch the page before the oldest rendered message and keep the scroll position
+function loadOlderHistory() {
+  if (!historyQuery || historyExhausted || historyLoading) return;
+  let oldestId = $('#chat-body .message').first().data('msg-id');
+  if (!oldestId) return;
+  let query = historyQuery;
+  let chatBody = document.getElementById('chat-body');
+  historyLoading = true;
+  $.get('/history', Object.assign({before_id: oldestId, limit: HISTORY_PAGE_SIZE}, query), function(data) {
+    historyLoading = false;
+    if (query !== historyQuery) return; // chat switched while loading
+    historyExhausted = data.length < HISTORY_PAGE_SIZE;
+    let prevHeight = chatBody.scrollHeight;
+    data.slice().reverse().forEach(function(msg) {
+      renderMessage(msg, false, true);
+    });
+    chatBody.scrollTop += chatBody.scrollHeight - prevHeight;
+  }).fail(function() {
+    historyLoading = false;
+  });
+}
+
+function ajaxPromise(options) {
+  return new Promise(function(resolve, reject) {
+    $.ajax(options).done(resolve).fail(function(xhr) { reject(xhr); });
+  });
+}
+
+function uploadError(xhr) {
+  return (xhr && xhr.responseJSON && xhr.responseJSON.error) || 'Unknown error';
+}
+
+// SHA-256 of a file as hex, read one upload chunk at a time so memory stays bounded
+async function hashFile(file) {
+  let hash = new Sha256();
+  for (let offset = 0; offset < file.size; offset += UPLOAD_CHUNK_SIZE) {
+    hash.update(new Uint8Array(await file.slice(offset, offset + UPLOAD_CHUNK_SIZE).arrayBuffer()));
+  }
+  return hash.hex();
+}
+
+// Upload a file and resolve with the /upload style response ({file_id, filename, ...})
+async function uploadFile(file, onProgress) {
+  let sha256 = null;
+  if (file.size >= HASH_FIRST_MIN_SIZE && file.size <= HASH_FIRST_MAX_SIZE) {
+    sha256 = await hashFile(file);
+  }
+  if (sha256) {
+    try {
+      return await ajaxPromise({
+        url: '/upload/check', type: 'POST', contentType: 'application/json',
+        data: JSON.stringify({filename: file.name, size: file.size, mimetype: file.type, sha256: sha256})
+      });
+    } catch (xhr) {
+      if (xhr.status !== 404) throw xhr;
+    }
+  }
+  if (file.size < CHUNKED_UPLOAD_THRESHOLD) {
+    let formData = new FormData();
+    formData.append('file', file);
+    return ajaxPromise({url: '/upload', type: 'POST', data: formData, processData: false, contentType: false});
+  }
+  return uploadFileChunked(file, onProgress, sha256);
+}
+
+// Send a large file in offset-addressed chunks. A dropped connection only costs the
+// chunk in flight: the client asks the server for its offset and carries on from there.
+// The upload id is kept in localStorage so a reload can resume the same upload.
+async function uploadFileChunked(file, onProgress, sha256) {
+  let resumeKey = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+  let status = null;
+  let savedId = localStorage.getItem(resumeKey);
+  if (savedId) {
+    try {
+      status = await ajaxPromise({url: '/upload/' + savedId, type: 'GET'});
+    } catch (xhr) {
+      localStorage.removeItem(resumeKey);
+    }
+  }
+  if (!status) {
+    status = await ajaxPromise({
+      url: '/upload/init', type: 'POST', contentType: 'application/json',
+      data: JSON.stringify({filename: file.name, size: file.size, mimetype: file.type})
+    });
+    localStorage.setItem(resumeKey, status.upload_id);
+  }
+  let uploadId = status.upload_id;
+  let offset = status.offset;
+  let retries = 0;
+  while (offset < file.size) {
+    if (onProgress) onProgress(offset / file.size);
+    try {
+      status = await ajaxPromise({
+        url: '/upload/' + uploadId + '?offset=' + offset, type: 'PUT',
+        data: file.slice(offset, offset + UPLOAD_CHUNK_SIZE),
+        processData: false, contentType: 'application/octet-stream'
+      });
+      offset = status.offset;
+      retries = 0;
+    } catch (xhr) {
+      if (xhr.status && xhr.status !== 409 && xhr.status < 500) throw xhr;
+      if (++retries > UPLOAD_MAX_RETRIES) throw xhr;
+      await new Promise(function(r) { setTimeout(r, Math.min(1000 * 2 ** retries, 30000)); });
+      try {
+        offset = (await ajaxPromise({url: '/upload/' + uploadId, type: 'GET'})).offset;
+      } catch (e) { /* still offline; retry the same offset */ }
+    }
+  }
+  if (onProgress) onProgress(1);
+  let resp = await ajaxPromise({
+    url: '/upload/' + uploadId + '/finalize', type: 'POST', contentType: 'application/json',
+    data: JSON.stringify(sha256 ? {sha256: sha256} : {})
+  });
+  localStorage.removeItem(resumeKey);
+  return resp;
+}
+
 // Remove updateUserList(users) and instead use only /users_status as the source of truth
 function updateUserListFromStatus(statusList) {
   let ul = $('#user-list');
@@ -113,81 +287,155 @@ function updateUserListFromStatus(statusList) {
   statusList.forEach(u => {
     if (u.username !== USERNAME) groupSel.append(`<option value="${u.username}">${u.username}</option>`);
   });
+  renderAllBadges();
 }
 
-// Notification badge logic
-function showBadge(user) {
-  if (user !== USERNAME) {
-    let badge = $(`#badge-${user}`);
-    let count = parseInt(badge.attr('data-count')) || 0;
-    count++;
-    badge.attr('data-count', count);
+// Notification badge logic: unread counts per chat (username or 'group-<id>'), seeded from /conversations
+let unreadCounts = {};
+
+// Conversation keys go through CSS.escape: usernames may contain characters that are special in selectors
+function badgeFor(chat) {
+  if (chat.startsWith('group-')) {
+    return $(`#group-list .group-item[data-group-id="${CSS.escape(chat.slice('group-'.length))}"] .group-badge`);
+  }
+  return $(`#badge-${CSS.escape(chat)}`);
+}
+
+function userItemFor(username) {
+  return $(`#user-list .user-item[data-user="${CSS.escape(username)}"]`);
+}
+
+function renderBadge(chat) {
+  let badge = badgeFor(chat);
+  let count = unreadCounts[chat] || 0;
+  badge.attr('data-count', count);
+  if (count) {
     badge.text(count === 1 ? 'NEW' : count);
     badge.show();
+  } else {
+    badge.text('');
+    badge.hide();
   }
 }
-function clearBadge(user) {
-  let badge = $(`#badge-${user}`);
-  badge.attr('data-count', 0);
-  badge.text('');
-  badge.hide();
 
-  
+function renderAllBadges() {
+  Object.keys(unreadCounts).forEach(renderBadge);
+}
+
+function loadUnreadCounts() {
+  $.get('/conversations', function(conversations) {
+    unreadCounts = {};
+    conversations.forEach(function(c) {
+      if (c.unread && c.chat !== currentRecipients) unreadCounts[c.chat] = c.unread;
+    });
+    renderAllBadges();
+  });
+}
+
+function showBadge(user) {
+  if (user !== USERNAME) {
+    unreadCounts[user] = (unreadCounts[user] || 0) + 1;
+    renderBadge(user);
+  }
+}
+function clearBadge(user) {
+  unreadCounts[user] = 0;
+  renderBadge(user);
 }
 
 // Show badge for group
 function showGroupBadge(groupId) {
-  let badge = $(`#group-list .group-item[data-group-id='${groupId}'] .group-badge`);
-  let count = parseInt(badge.attr('data-count')) || 0;
-  count++;
-  badge.attr('data-count', count);
-  badge.text(count === 1 ? 'NEW' : count);
-  badge.show();
+  showBadge('group-' + groupId);
 }
 // Clear badge for group
 function clearGroupBadge(groupId) {
-  let badge = $(`#group-list .group-item[data-group-id='${groupId}'] .group-badge`);
-  badge.attr('data-count', 0);
-  badge.text('');
-  badge.hide();
+  clearBadge('group-' + groupId);
 }
 
-// Typing indicator logic
+// Typing indicator logic: the server expires typists after a few seconds, so while typing
+// the event only needs repeating every TYPING_REFRESH_MS
+const TYPING_REFRESH_MS = 2000;
 let typingTimeout;
+let lastTypingSent = 0;
 let lastTypedRecipient = null;
+let typingByChat = {};
 $('#message-input').on('input', function() {
   if (!currentRecipients) return;
-  if (lastTypedRecipient !== currentRecipients) {
+  const now = Date.now();
+  if (lastTypedRecipient !== currentRecipients || now - lastTypingSent > TYPING_REFRESH_MS) {
     lastTypedRecipient = currentRecipients;
+    lastTypingSent = now;
+    socket.emit('typing', {to: currentRecipients});
   }
-  socket.emit('typing', {to: currentRecipients});
   clearTimeout(typingTimeout);
   typingTimeout = setTimeout(function() {
-    socket.emit('stop_typing', {to: currentRecipients});
+    socket.emit('stop_typing', {to: lastTypedRecipient});
+    lastTypingSent = 0;
   }, 1500);
 });
 
-socket.on('show_typing', function(data) {
-  if (currentRecipients === data.from || currentRecipients === data.room) {
-    if ($('#typing-indicator').length === 0) {
-      $('#chat-body').append('<div id="typing-indicator" class="text-muted" style="margin:8px 0 0 8px;">Typing...</div>');
-      scrollChatToBottom();
-    }
-  }
-});
-socket.on('hide_typing', function(data) {
+function renderTypingIndicator() {
+  const names = (typingByChat[currentRecipients] || []).filter(n => n !== USERNAME);
   $('#typing-indicator').remove();
+  if (!names.length) return;
+  const text = currentRecipients.startsWith('group-') ? names.join(', ') + ' typing...' : 'Typing...';
+  $('#chat-body').append($('<div id="typing-indicator" class="text-muted" style="margin:8px 0 0 8px;"></div>').text(text));
+  scrollChatToBottom();
+}
+
+socket.on('typing_state', function(data) {
+  typingByChat[data.chat] = data.typing;
+  if (currentRecipients === data.chat) renderTypingIndicator();
 });
 
 $(function() {
-  socket.emit('join', {room: USERNAME});
   $('#chat-body').html('<div class="text-center text-muted">Select a user or group to start chatting.</div>');
-  // Use /users_status for initial user list
-  $.get('/users_status', updateUserListFromStatus);
+  $('#chat-body').on('scroll', function() {
+    if (this.scrollTop < 40) loadOlderHistory();
+  });
+  // Use /users_status for initial user list, then apply presence deltas
+  function refreshUserStatus() {
+    $.get('/users_status', function(users, status, xhr) {
+      presenceVersion = parseInt(xhr.getResponseHeader('X-Presence-Version'));
+      updateUserListFromStatus(users);
+    });
+  }
+  refreshUserStatus();
+
+  function applyPresenceDelta(delta) {
+    let known = delta.joined.concat(delta.left).every(u =>
+      u === USERNAME || userItemFor(u).length);
+    if (!known) {
+      refreshUserStatus(); // a new user appeared
+      return;
+    }
+    presenceVersion = delta.version;
+    delta.joined.forEach(u => userItemFor(u).find('.status-dot')
+      .removeClass('status-offline').addClass('status-online'));
+    delta.left.forEach(u => userItemFor(u).find('.status-dot')
+      .removeClass('status-online').addClass('status-offline'));
+  }
 
-  // Listen for user_list and refresh from /users_status
-  socket.on('user_list', function() {
-    $.get('/users_status', updateUserListFromStatus);
+  // Fetch only the changes since our version; the server falls back to a full list when needed
+  function catchUpPresence() {
+    $.get('/users_status', {since: presenceVersion}, function(resp, status, xhr) {
+      if (Array.isArray(resp)) {
+        presenceVersion = parseInt(xhr.getResponseHeader('X-Presence-Version'));
+        updateUserListFromStatus(resp);
+      } else if (resp.version > presenceVersion) {
+        applyPresenceDelta(resp);
+      }
+    });
+  }
+
+  socket.on('presence_delta', function(delta) {
+    if (presenceVersion === null || isNaN(presenceVersion)) return; // initial snapshot still loading
+    if (delta.version <= presenceVersion) return; // already reflected in the snapshot
+    if (delta.version !== presenceVersion + 1) {
+      catchUpPresence(); // missed an update
+      return;
+    }
+    applyPresenceDelta(delta);
   });
 
   socket.on('receive_message', function(msg) {
@@ -209,7 +457,7 @@ $(function() {
     ) {
       showBadge(msg.sender);
       // --- Move user to top of user list ---
-      let userItem = $("#user-list .user-item[data-user='" + msg.sender + "']");
+      let userItem = userItemFor(msg.sender);
       if (userItem.length) {
         userItem.prependTo('#user-list');
       }
@@ -246,10 +494,17 @@ $(function() {
     }
   });
 
-  socket.on('message_read', function(data) {
-    const msgId = data.msg_id;
+  function showReadTicks(msgId) {
     // Update all matching ticks in the DOM, even if chat is not open
     $(".message[data-msg-id='" + msgId + "'] .msg-ticks").html("<i class='bi bi-check2-all' style='color:#2196f3;font-size:1.2em;'></i>");
+  }
+
+  socket.on('message_read', function(data) {
+    showReadTicks(data.msg_id);
+  });
+
+  socket.on('messages_read', function(data) {
+    data.msg_ids.forEach(showReadTicks);
   });
 
   function saveCurrentDraft() {
@@ -323,36 +578,27 @@ $(function() {
     };
     if (replyToMsgId) data.reply_to = replyToMsgId;
     if (file) {
-      let formData = new FormData();
-      formData.append('file', file);
       $('#file-name').text('Uploading...');
       $('#message-form button[type="submit"]').prop('disabled', true);
-      $.ajax({
-        url: '/upload',
-        type: 'POST',
-        data: formData,
-        processData: false,
-        contentType: false,
-        success: function(resp) {
-          if (resp.file_id) {
-            data.file_id = resp.file_id;
-            socket.emit('send_message', data);
-          } else {
-            alert('File upload failed.');
-          }
-        },
-        error: function(xhr) {
-          alert('File upload failed: ' + (xhr.responseJSON?.error || 'Unknown error'));
-        },
-        complete: function() {
-          $('#file-input').val('');
-          $('#file-name').text('No file');
-          $('#file-preview').html('');
-          $('#message-input').val('');
-          replyToMsgId = null;
-          $('#reply-preview-bar').remove();
-          $('#message-form button[type="submit"]').prop('disabled', false);
+      uploadFile(file, function(fraction) {
+        $('#file-name').text('Uploading... ' + Math.floor(fraction * 100) + '%');
+      }).then(function(resp) {
+        if (resp.file_id) {
+          data.file_id = resp.file_id;
+          socket.emit('send_message', data);
+        } else {
+          alert('File upload failed.');
         }
+      }).catch(function(xhr) {
+        alert('File upload failed: ' + uploadError(xhr));
+      }).finally(function() {
+        $('#file-input').val('');
+        $('#file-name').text('No file');
+        $('#file-preview').html('');
+        $('#message-input').val('');
+        replyToMsgId = null;
+        $('#reply-preview-bar').remove();
+        $('#message-form button[type="submit"]').prop('disabled', false);
       });
     } else if (audioBlob) {
       let formData = new FormData();
@@ -568,6 +814,16 @@ $(document).on('click', function(e) {
 });
 // --- END Reply and React Handlers ---
 
+// Swap in a thumbnail/poster once the server has generated it
+socket.on('file_preview', function(data) {
+  let file = pendingPreviews[data.file_id];
+  if (!file) return;
+  delete pendingPreviews[data.file_id];
+  file.preview_url = data.preview_url;
+  file.preview_pending = false;
+  $(`.msg-file[data-file-id='${data.file_id}']`).replaceWith(renderFile(file));
+});
+
 // Update reactions in real time
 socket.on('update_reactions', function(data) {
   const msgId = data.msg_id;
@@ -647,9 +903,11 @@ $(document).ready(function() {
           $list.append(`<li class="list-group-item group-item d-flex align-items-center justify-content-between" data-group-id="${g.id}">${icon}<span>${g.name}</span>${badge}</li>`);
         });
       }
+      renderAllBadges();
     });
   }
   loadGroups();
+  loadUnreadCounts();
 
   // Open create group modal
   $('#open-create-group-modal').click(function() {
@@ -733,8 +991,11 @@ $(document).ready(function() {
   // Load group chat history
   function loadGroupHistory(groupId) {
     $('#chat-body').html('<div class="text-center text-muted">Loading group chat...</div>');
-    $.get('/history', { group_id: groupId }, function(data) {
+    historyQuery = { group_id: groupId };
+    historyExhausted = false;
+    $.get('/history', historyQuery, function(data) {
       $('#chat-body').empty();
+      historyExhausted = data.length < HISTORY_PAGE_SIZE;
       data.forEach(function(msg, idx) {
         renderMessage(msg, idx === data.length - 1);
       });
@@ -865,8 +1126,6 @@ $('#delete-group-btn').on('click', function() {
       $('#chat-body').html('<div class="text-center text-muted">Select a user or group to start chatting.</div>');
       currentRecipients = null;
       updateGroupInfoBtn();
-      // Now emit to server so all clients update
-      socket.emit('group_deleted', { group_id: currentGroupId });
     } else {
       alert(resp.error || 'Failed to delete group');
     }
@@ -0,0 +1,104 @@
+"""Query-count regression test for /history.
+
+load_history_page must load a page with a fixed number of statements,
+however many messages it holds (no per-message queries for attached
+files, reply parents or reactions).
+"""
+import importlib
+import io
+import os
+import shutil
+import sys
+
+import pytest
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The conversation, the page, the archive segments, then files, reply parents and reactions in bulk
+HISTORY_PAGE_STATEMENTS = 6
+
+
+@pytest.fixture(scope='module')
+def chat(tmp_path_factory):
+    """Import the app from a copy of the tree so its database, key and uploads live in a temp dir."""
+    workdir = tmp_path_factory.mktemp('chat')
+    for name in ('app.py', 'lanbus.py'):
+        shutil.copy(os.path.join(ROOT, name), workdir)
+    shutil.copytree(os.path.join(ROOT, 'templates'), workdir / 'templates')
+    os.makedirs(workdir / 'static' / 'uploads')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, str(workdir))
+    try:
+        yield importlib.import_module('app')
+    finally:
+        sys.path.remove(str(workdir))
+        sys.modules.pop('app', None)
+        os.chdir(cwd)
+
+
+def make_user(chat, username):
+    with chat.app.app_context():
+        chat.db.session.add(chat.User(username=username, is_admin=False,
+                                      password=chat.cipher_suite.encrypt(b'pw').decode()))
+        chat.db.session.commit()
+    client = chat.app.test_client()
+    assert client.post('/', data={'username': username, 'password': 'pw'}).status_code == 302
+    return client
+
+
+@pytest.fixture(scope='module')
+def history(chat):
+    """A direct chat with files, replies and reactions on most of its messages."""
+    alice, bob = make_user(chat, 'alice'), make_user(chat, 'bob')
+    sockets = {name: chat.socketio.test_client(chat.app, flask_test_client=client)
+               for name, client in (('alice', alice), ('bob', bob))}
+    ids = []
+    for i in range(60):
+        sender, to = ('alice', 'bob') if i % 2 else ('bob', 'alice')
+        data = {'recipients': to, 'content': f'message {i}'}
+        if i % 3 == 0:
+            client = alice if sender == 'alice' else bob
+            upload = client.post('/upload', data={'file': (io.BytesIO(b'file %d' % i), f'f{i}.txt', 'text/plain')},
+                                 content_type='multipart/form-data')
+            data['file_id'] = upload.json['file_id']
+        if ids and i % 2 == 0:
+            data['reply_to'] = ids[-1]
+        ids.append(sockets[sender].emit('send_message', data, callback=True)['id'])
+        if i % 4 == 0:
+            sockets['alice' if sender == 'bob' else 'bob'].emit('react_message', {'msg_id': ids[-1], 'emoji': '👍'})
+    return ids
+
+
+def count_statements(chat, limit, before_id=None):
+    """Run load_history_page and return (messages on the page, statements executed)."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with chat.app.app_context():
+        engines = [chat.db.engines[None], chat.db.engines['reader']]
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', record)
+        try:
+            page = chat.load_history_page('alice', 'bob', None, before_id, None, limit)
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', record)
+    return page, len(statements)
+
+
+def test_history_page_statement_count_does_not_grow_with_page_size(chat, history):
+    small, small_count = count_statements(chat, 5)
+    large, large_count = count_statements(chat, 50)
+    assert len(small) == 5 and len(large) == 50
+    assert any(m['file'] for m in large) and any(m['reply_to'] for m in large) and any(m['reactions'] for m in large)
+    assert small_count == large_count == HISTORY_PAGE_STATEMENTS
+
+
+def test_older_history_page_uses_the_same_statements(chat, history):
+    _, first_count = count_statements(chat, 20)
+    page, older_count = count_statements(chat, 20, before_id=history[30])
+    assert [m['id'] for m in page] == history[10:30]
+    assert older_count == first_count == HISTORY_PAGE_STATEMENTS